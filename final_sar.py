@@ -29,12 +29,16 @@ The objective of this tutorial is to train a convolutional neural network (CNN)
 # Import required libraries
 import os
 import csv
+import threading
 import gdal
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import tensorflow as tf
+from numba import njit, prange
 from osgeo import ogr
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
 from keras.api._v2.keras import datasets, layers, models, Sequential
 from keras_preprocessing.image import ImageDataGenerator
 
@@ -94,9 +98,22 @@ validation_scene_ids = val_y_df.scene_id.unique()
 print(training_scene_ids)
 print(validation_scene_ids)
 
-# As each SAR image only consists of a single band, open it as an array (grayscale) in a dictionary with the scene id as the key
-train_scenes = {id : train_scenes_list[i].GetRasterBand(1).ReadAsArray() for i, id in enumerate(training_scene_ids)}
-val_scenes = {id : val_scenes_list[i].GetRasterBand(1).ReadAsArray() for i, id in enumerate(validation_scene_ids)}
+# Helper function for splitting the labels by scene into numpy arrays of rows, columns and 0/1 labels, cast once up front
+def labels_by_scene(df):
+    df = df.astype({'detect_scene_row': np.int32, 'detect_scene_column': np.int32, 'is_vessel': bool})
+    return {id : (labels.detect_scene_row.to_numpy(), labels.detect_scene_column.to_numpy(), labels.is_vessel.to_numpy().astype(int))
+            for id, labels in df.groupby('scene_id')}
+
+train_labels = labels_by_scene(train_y_df)
+val_labels = labels_by_scene(val_y_df)
+
+# Keep each scene in a dictionary with the scene id as the key.
+# The scenes are never read into memory whole, only the subscenes we cut from them are read from disk
+train_scenes = {id : train_scenes_list[i] for i, id in enumerate(training_scene_ids)}
+val_scenes = {id : val_scenes_list[i] for i, id in enumerate(validation_scene_ids)}
+
+# Let GDAL cache up to 500MB of decoded blocks so overlapping subscenes are not decoded twice
+gdal.SetCacheMax(500 << 20)
 
 """Visualizing the Training Scenes and Validation Scenes (with labels)
 
@@ -105,99 +122,166 @@ val_scenes = {id : val_scenes_list[i].GetRasterBand(1).ReadAsArray() for i, id i
 (I am using QGIS to visualize the imagery as displaying it with a library such as matplotlib would crash the .ipybn. The images are too large for the kernel to handle unless your hardware has loads of RAM)
 """
 
-# The arrays that will contain all our training subscenes to feed to the CNN
-train_X = []
+# GDAL datasets must not be shared between threads, so each thread opens its own handle to the scenes it reads from
+thread_local = threading.local()
+
+# Helper function for reading the 256x256px subscene centered on (row, col) on the current thread
+def read_tile(filename, row, col):
+    if not hasattr(thread_local, 'datasets'):
+        thread_local.datasets = {}
+    if filename not in thread_local.datasets:
+        thread_local.datasets[filename] = gdal.Open(filename)
+    # As each SAR image only consists of a single band, read it as an array (grayscale)
+    return thread_local.datasets[filename].GetRasterBand(1).ReadAsArray(int(col)-128, int(row)-128, 256, 256)
+
+# GDAL releases the GIL while it reads, so the subscenes are read on a pool of threads
+pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Helper function for reading the 256x256px subscenes centered on each (row, col) from a scene
+def read_tiles(scene, rows, cols):
+    tiles = list(pool.map(read_tile, repeat(scene.GetDescription()), rows, cols))
+    return np.array(tiles, dtype=np.float32).reshape(-1, 256, 256)
+
+# Helper function for finding the subscenes with no data in them, compiled with numba so each one stops at the first nodata pixel
+@njit(parallel=True)
+def has_nodata(tiles):
+    result = np.zeros(len(tiles), dtype=np.bool_)
+    for i in prange(len(tiles)):
+        for r in range(tiles.shape[1]):
+            for c in range(tiles.shape[2]):
+                if tiles[i, r, c] == -32768.0:
+                    result[i] = True
+                    break
+            if result[i]:
+                break
+    return result
+
+# Helper function for cutting a 256x256px subscene centered on each (row, col) in a scene
+def extract_tiles(scene, rows, cols):
+    # Subscenes too close to the edge of the scene would run off of it
+    keep = (rows >= 128) & (rows <= scene.RasterYSize-128) & (cols >= 128) & (cols <= scene.RasterXSize-128)
+    tiles = read_tiles(scene, rows[keep], cols[keep])
+
+    # Drop any subscene that has no data in it
+    has_data = ~has_nodata(tiles)
+    keep[keep] = has_data
+    return tiles[has_data], keep
+
+# Physical range of the VH backscatter in dB, so the training and validation subscenes are normalized the same way
+VH_DB_LO, VH_DB_HI = -50.0, 10.0
+
+# Helper function for normalizing subscenes to 0-255 and storing them as a byte per pixel, a quarter the size of float32.
+# The models scale them back to 0-1 with their first layer
+def quantize(tiles):
+    return np.rint(np.clip((tiles - VH_DB_LO) / (VH_DB_HI - VH_DB_LO) * 255, 0, 255)).astype(np.uint8)
+
+# The subscenes are streamed to disk as they are cut, only the labels are kept in memory
+train_file = open('train_X.dat', 'wb')
 train_y = []
 
+# Flip-n-Slide: cut each label at 8 offsets so it is no longer always in the center of its subscene,
+# and give each offset a different flip or rotation so the overlapping subscenes are not copies of each other
+FLIP_N_SLIDE = [
+    ((-64, -64), lambda t: t),
+    ((-64,   0), lambda t: np.rot90(t, 1, axes=(1,2))),
+    ((-64,  64), lambda t: np.rot90(t, 2, axes=(1,2))),
+    ((  0, -64), lambda t: np.rot90(t, 3, axes=(1,2))),
+    ((  0,  64), lambda t: np.flip(t, axis=2)),
+    (( 64, -64), lambda t: np.rot90(np.flip(t, axis=2), 1, axes=(1,2))),
+    (( 64,   0), lambda t: np.rot90(np.flip(t, axis=2), 2, axes=(1,2))),
+    (( 64,  64), lambda t: np.rot90(np.flip(t, axis=2), 3, axes=(1,2))),
+]
+
 # Iterate through each scene in the dictionary
 for id, scene in train_scenes.items():
-
-    for index, r in train_y_df[train_y_df['scene_id'] == id].iterrows():
-        row = r.detect_scene_row
-        col = r.detect_scene_column
-        label = 1 if r.is_vessel else 0
-        subset = scene[row-128:row+128,col-128:col+128]
-
-        if subset.min() != -32768.0:
-            train_X.append(subset)
-            train_y.append(label)
-
-# Helper function for creating subscenes without labels
-def img_contains_label(x, y, id):
-    for index, row in train_y_df[train_y_df['scene_id'] == id].iterrows():
-        label_row = r.detect_scene_row
-        label_col = r.detect_scene_column
-        if label_row > x-128 and label_row < x+128 and label_col > y-128 and label_col < y+128:
-            # vessel is in image
-            return True
-    return False
+    rows, cols, is_vessel = train_labels[id]
+
+    for (row_offset, col_offset), transform in FLIP_N_SLIDE:
+        tiles, keep = extract_tiles(scene, rows+row_offset, cols+col_offset)
+        transform(quantize(tiles)).tofile(train_file)
+        train_y.extend(is_vessel[keep])
+
+# Helper function for checking which of the subscenes centered on (x, y) contain a label, compiled with numba
+@njit(parallel=True)
+def contains_label(x, y, label_rows, label_cols):
+    result = np.zeros(len(x), dtype=np.bool_)
+    for i in prange(len(x)):
+        for j in range(len(label_rows)):
+            if abs(x[i] - label_rows[j]) < 128 and abs(y[i] - label_cols[j]) < 128:
+                result[i] = True
+                break
+    return result
 
 # Number of images to add to balance out the class
 num_img_to_add = sum(train_y)-(len(train_y)-sum(train_y))
 
 # The training set is unbalanced, add no vessel subscenes
+rng = np.random.default_rng()
+num_img_per_scene = num_img_to_add // len(train_scenes)
+
 for id, scene in train_scenes.items():
-    
-    for i in range(num_img_to_add // len(train_scenes)):
-        max_x = len(scene)
-        max_y = len(scene[0])
-
-        while True: 
-            x = np.random.randint(128, max_x-128)
-            y = np.random.randint(128, max_y-128)
-            subset = scene[x-128:x+128,y-128:y+128]
-           
-            if img_contains_label(x, y, id) or subset.min() == -32768.0:
-                continue
-
-            train_X.append(subset)
-            train_y.append(0)
-            break
-
-# Save as numpy arrays for easy of use with Keras
-train_X = np.array(train_X)
+    label_rows, label_cols, _ = train_labels[id]
+    negatives = np.empty((0, 256, 256), dtype=np.float32)
+
+    # Draw candidates in batches, oversampling to absorb the ones that contain a label
+    while len(negatives) < num_img_per_scene:
+        needed = num_img_per_scene - len(negatives)
+        x = rng.integers(128, scene.RasterYSize-128, size=4*needed)
+        y = rng.integers(128, scene.RasterXSize-128, size=4*needed)
+
+        # Only read the candidates without a label, and drop the ones that turn out to have no data
+        clear = ~contains_label(x, y, label_rows, label_cols)
+        tiles = read_tiles(scene, x[clear][:needed], y[clear][:needed])
+        negatives = np.concatenate((negatives, tiles[~has_nodata(tiles)]))
+
+    quantize(negatives).tofile(train_file)
+    train_y.extend([0] * len(negatives))
+
+train_file.close()
+
+# Map the subscenes back from disk and save the labels as a numpy array for ease of use with Keras
 train_y = np.array(train_y)
+train_X = np.memmap('train_X.dat', dtype=np.uint8, mode='r', shape=(len(train_y), 256, 256))
 
 # Much better class balance!
 np.unique(train_y, return_counts=True)
 
 # Build the validation dataset
-val_X = []
+val_file = open('val_X.dat', 'wb')
 val_y = []
 
 for id, scene in val_scenes.items():
-    
-    for index, r in val_y_df[val_y_df['scene_id'] == id].iterrows():
-        row = r.detect_scene_row
-        col = r.detect_scene_column
-        label = 1 if r.is_vessel else 0
-        subset = scene[row-128:row+128,col-128:col+128] # all vessels are centered...bad
-
-        if subset.min() != -32768.0:
-            val_X.append(subset)
-            val_y.append(label)
-
-val_X = np.array(val_X)
-val_y = np.array(val_y)
+    rows, cols, is_vessel = val_labels[id]
 
-# The original arrays are very large and no longer need free them from memory
-del train_scenes
-del val_scenes
+    tiles, keep = extract_tiles(scene, rows, cols) # all vessels are centered...bad
+    quantize(tiles).tofile(val_file)
+    val_y.extend(is_vessel[keep])
 
-# Normalize data
-train_X = (train_X - train_X.min()) / (train_X.max() - train_X.min())
-val_X = (val_X - val_X.min()) / (val_X.max() - val_X.min())
+val_file.close()
 
-# Visualize some scenes
-plt.figure(figsize=(15,15))
-for i in range(25):
-    plt.subplot(5,5,i+1)
-    plt.imshow(train_X[i*20], interpolation=None, cmap='gray', vmin=np.nanmin(train_X[i*20]), vmax=np.nanmax(train_X[i*20]))
+val_y = np.array(val_y)
+val_X = np.memmap('val_X.dat', dtype=np.uint8, mode='r', shape=(len(val_y), 256, 256))
+
+# Helper function for showing 25 subscenes as a single 5x5 image, each stretched to its own range, with a caption under each
+def show_grid(tiles, captions, figsize):
+    tiles = tiles.astype(np.float32)
+    lo = tiles.min(axis=(1,2), keepdims=True)
+    hi = tiles.max(axis=(1,2), keepdims=True)
+    tiles = (tiles - lo) / np.maximum(hi - lo, 1)
+    grid = np.block([[tiles[r*5+c] for c in range(5)] for r in range(5)])
+
+    plt.figure(figsize=figsize)
+    plt.imshow(grid, interpolation=None, cmap='gray', vmin=0, vmax=1)
+    for i, caption in enumerate(captions):
+        plt.text((i%5)*256 + 128, (i//5)*256 + 248, caption, color='yellow', ha='center', va='bottom')
     plt.xticks([])
     plt.yticks([])
-    plt.xlabel(train_y[i*20])
     plt.grid(False)
-plt.show()
+    plt.show()
+
+# Visualize some scenes
+index = np.arange(25) * 20
+show_grid(train_X[index], train_y[index], figsize=(15,15))
 
 """Displayed are a few examples of the subscenes that comprise the training data.
 
@@ -207,29 +291,57 @@ plt.show()
 (Parts 3 and 4 are broken into two sections. One for each model trained.)
 ### Model 1: Custom Design
 
-For my first attempt at building an accurate model, I created a relatively simple convolutional neural network. To bolster the amount of data I could feed into the model, I decided to perform data augmentation. This is a technique that slightly modifies the original images through flipping, rotating, or zooming to create new synthetic data. This is important as I have a limited number of scenes in my 'tiny' dataset and I want to feed as much good data as I can into my model.
+For my first attempt at building an accurate model, I created a relatively simple convolutional neural network. To bolster the amount of data I could feed into the model, I decided to perform data augmentation. This is a technique that slightly modifies the original images through flipping, rotating, or zooming to create new synthetic data. This is important as I have a limited number of scenes in my 'tiny' dataset and I want to feed as much good data as I can into my model. For SAR imagery I only flip and rotate in 90 degree steps, as these just move pixels around without resampling and changing the backscatter values.
 """
 
-data_augmentation = Sequential([
-  layers.RandomFlip("horizontal_and_vertical"),
-  layers.RandomRotation(0.1),
-  layers.RandomZoom(height_factor=(0,0.1)),
-])
-
-# Original training set
-train_X.shape
-
-train_X = np.concatenate((train_X, data_augmentation(train_X).numpy()))
-train_y = np.concatenate((train_y, train_y))
-
-# New training set. The size has doubled!
-train_X.shape
-
-"""My custom model is mainly comprised of three convolutional, two pooling, and two dense layers. The convolutional layers are the building blocks of this model that apply a filter to create a feature map. The feature map values are then passed through the ReLu activation function. I chose ReLu for my convolutional layers for its speed. The pooling layers then reduce the matrix from the convolutional layer into a smaller matrix. I have several dropout layers in an effort to prevent overfitting. Near the end of the model, I have several fully connected or dense layers. The first one is directly connected to a flatten layer as the dense layer requires input to be 1D. I use sigmoid activation here as it is <a href="https://towardsdatascience.com/how-to-choose-the-right-activation-function-for-neural-networks-3941ff0e6f9c#:~:text=In%20a%20binary%20classifier%2C%20we,with%20one%20node%20per%20class.">shown to improve binary classification results</a>. Finally, I use my last dense layer to classify my features into one of two classes (vessel or no vessel)."""
+class SARAug(layers.Layer):
+    def call(self, x, training=None):
+        if not training:
+            return x
+        # A random transpose followed by random flips covers all 8 rotations and flips of a square subscene
+        transpose = tf.random.uniform([tf.shape(x)[0], 1, 1, 1]) < 0.5
+        x = tf.where(transpose, tf.transpose(x, [0, 2, 1, 3]), x)
+        x = tf.image.random_flip_left_right(x)
+        return tf.image.random_flip_up_down(x)
+
+data_augmentation = SARAug()
+
+# Helper function for feeding the memory-mapped subscenes to Keras, augmenting them on the fly
+def make_dataset(X, y, augment=False, shuffle=False, batch_size=32):
+    def generator():
+        # Visit the subscenes in a new order every epoch
+        order = np.random.permutation(len(X)) if shuffle else np.arange(len(X))
+        for i in range(0, len(X), batch_size):
+            # Read each batch from the memory-mapped file front to back
+            batch = np.sort(order[i:i+batch_size])
+            yield X[batch], y[batch]
+
+    ds = tf.data.Dataset.from_generator(generator, output_signature=(
+        tf.TensorSpec(shape=(None, 256, 256), dtype=tf.uint8),
+        tf.TensorSpec(shape=(None,), dtype=tf.int64)))
+
+    def preprocess(x, y):
+        x = x[..., tf.newaxis]
+        # A fresh random augmentation of every batch each epoch, instead of a single augmented copy held in RAM
+        if augment:
+            x = data_augmentation(x, training=True)
+        return x, y
+
+    ds = ds.map(preprocess, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+train_ds = make_dataset(train_X, train_y, augment=True, shuffle=True)
+val_ds = make_dataset(val_X, val_y)
+
+# Training set without augmentation, for evaluation
+train_eval_ds = make_dataset(train_X, train_y)
+
+"""My custom model is mainly comprised of three convolutional, two pooling, and two dense layers. The convolutional layers are the building blocks of this model that apply a filter to create a feature map. The feature map values are then passed through the ReLu activation function. I chose ReLu for my convolutional layers for its speed. The pooling layers then reduce the matrix from the convolutional layer into a smaller matrix. I have several dropout layers in an effort to prevent overfitting. Near the end of the model, I have several fully connected or dense layers. The first one is directly connected to a flatten layer as the dense layer requires input to be 1D. I use sigmoid activation here as it is <a href="https://towardsdatascience.com/how-to-choose-the-right-activation-function-for-neural-networks-3941ff0e6f9c#:~:text=In%20a%20binary%20classifier%2C%20we,with%20one%20node%20per%20class.">shown to improve binary classification results</a>. Finally, I use my last dense layer to classify my features into one of two classes (vessel or no vessel). With only two classes, a single output is enough: above zero means vessel, below zero means no vessel."""
 
 model = models.Sequential()
 
-model.add(layers.Conv2D(32, (3, 3), activation='relu', input_shape=(256, 256, 1)))
+model.add(layers.Rescaling(1./255, input_shape=(256, 256, 1)))
+model.add(layers.Conv2D(32, (3, 3), activation='relu'))
 model.add(layers.MaxPooling2D((2, 2)))
 model.add(layers.Conv2D(64, (3, 3), activation='relu'))
 model.add(layers.MaxPooling2D((2, 2)))
@@ -238,22 +350,22 @@ model.add(layers.Conv2D(64, (3, 3), activation='relu'))
 model.add(layers.Flatten())
 model.add(layers.Dense(64, activation='sigmoid',  kernel_regularizer='l2'))
 model.add(layers.Dropout(rate=0.1))
-model.add(layers.Dense(2))
+model.add(layers.Dense(1))
 
 model.summary()
 
 model.compile(optimizer='adam',
-              loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
-              metrics=['accuracy'])
+              loss=tf.keras.losses.BinaryCrossentropy(from_logits=True),
+              metrics=[tf.keras.metrics.BinaryAccuracy(name='accuracy', threshold=0.0)])
 
-history = model.fit(train_X, train_y, epochs=20, shuffle=True, validation_data=(val_X, val_y))
+history = model.fit(train_ds, epochs=20, validation_data=val_ds)
 
 # Evaluate the model on the train data
-train_loss, train_acc = model.evaluate(train_X, train_y, verbose=2)
+train_loss, train_acc = model.evaluate(train_eval_ds, verbose=2)
 print(f'Train accuracy: {100*train_acc:.2f}%')
 
 # Evaluate the model on the test data
-test_loss, test_acc = model.evaluate(val_X, val_y, verbose=2)
+test_loss, test_acc = model.evaluate(val_ds, verbose=2)
 print(f'Test accuracy: {100*test_acc:.2f}%')
 
 """My custom model does not perform well. It achieves extremely high training accuracy but is worse than a coin flip when it comes to the validation data. This is a classic example of overfitting which I attempted to correct through dropout layers and hyperparameter tuning but could not overcome."""
@@ -277,12 +389,13 @@ plt.legend()
 plt.tight_layout()
 plt.show()
 
-"""<a href="https://en.wikipedia.org/wiki/Softmax_function">Softmax</a> is a function that converts a vector of real numbers into a probability distribution. Here I use it to convert my model's predictions into two values, probability that the subscene is not a vessel and the probability that it is a vessel. """
+"""The <a href="https://en.wikipedia.org/wiki/Sigmoid_function">sigmoid</a> function squashes any real number into the range 0 to 1. Here I use it to convert my model's predictions into the probability that the subscene is a vessel. """
 
-# Predict and use softmax to convert to probability
-predictions = model.predict(val_X)
+# Predict and use sigmoid to convert to probability
+predictions = model.predict(val_ds)
 
-predictions = tf.nn.softmax(predictions).numpy()
+predictions = tf.sigmoid(predictions).numpy()[:, 0]
+predicted_labels = (predictions > 0.5).astype(int)
 
 """To demonstrate my model, I pick a random image in my validation dataset and compare its ground truth to my predicted value. I also show the image to visualize what my model choosing to classify."""
 
@@ -290,7 +403,7 @@ index = np.random.randint(0, len(val_X))
 
 plt.figure(figsize=(15,15))
 plt.imshow(val_X[index], cmap='gray', vmin=np.nanmin(val_X[index]), vmax=np.nanmax(val_X[index]))
-plt.title(f'Correct={val_y[index]}, Predicted={np.argmax(predictions[index])}')
+plt.title(f'Correct={val_y[index]}, Predicted={predicted_labels[index]}')
 
 """### Model 2: EfficientNetV2B0
 After poor performance with my custom model, I decided to apply transfer learning to my detection problem. Transfer learning is the act of reusing a previously trained model on a new problem. For my pretrained model I chose <a href="https://arxiv.org/abs/2104.00298"> EfficientNetV2</a> as I wanted a model that my hardware could handle in terms of RAM and training speed. EfficientNetV2 significantly outperforms other models of similar speed when comparing accuracy and was recently developed in 2021. I thought it would be interesting to test a new family of CNNs on a traditionally hard problem such as SAR vessel detection.
@@ -302,65 +415,87 @@ At a very broad level, EfficientNetV2 works through an improved progressive lear
 (EfficientNetv2 Example)
 """
 
+# Run EfficientNet's convolutions in float16 on the GPU, keeping float32 weights for numerical stability
+tf.keras.mixed_precision.set_global_policy('mixed_float16')
+
 base_model = tf.keras.applications.efficientnet_v2.EfficientNetV2B0(input_shape=(256, 256, 3),
                                                include_top=False,
                                                weights='imagenet',
                                                include_preprocessing=False)
 
-"""For our single band SAR imagery to be properly processed by EfficientNet, we need to project it into three bands (RedGreenBlue). To accomplish this, I copy the single band values into three bands. Viewing the shape of the resulting array shows how we projected all our 256x256px images into 3 'bands'."""
+"""For our single band SAR imagery to be properly processed by EfficientNet, we need to project it into three bands (RedGreenBlue). To accomplish this, I put a 1x1 convolution with all of its weights set to one in front of EfficientNet, which copies the single band values into three bands. Since this happens inside the model, only the single band ever has to be stored in memory or sent to the GPU."""
 
 # Our single band SAR image must be projected into 3 bands for use in EfficientNet
-train_X_RGB = np.repeat(train_X[..., np.newaxis], 3, -1)
-print(train_X_RGB.shape)
-
-val_X_RGB = np.repeat(val_X[..., np.newaxis], 3, -1)
-print(val_X_RGB.shape)
-
-# Put training data into model to get features
-features = base_model.predict(train_X_RGB)
-print(features.shape)
+gray2rgb = layers.Conv2D(3, 1, use_bias=False, kernel_initializer='ones', trainable=False, name='gray2rgb')
 
 # Freeze the base CNN to prevent EfficientNet from updating its weights
 base_model.trainable = False
 
-# Generate predictions from the block of features
+# Average each block of features from EfficientNet into a single vector
 global_average_layer = tf.keras.layers.GlobalAveragePooling2D()
-features_average = global_average_layer(features)
-print(features_average.shape)
 
-# We have only two classes, vessel or no vessel so we need to add a classification layer to convert features into one of these 2 classes
-prediction_layer = tf.keras.layers.Dense(2)
-prediction = prediction_layer(features_average)
-print(prediction.shape)
+# We have only two classes, vessel or no vessel so we need to add a classification layer to convert features into a single vessel score.
+# It stays in float32 so the loss is computed at full precision
+prediction_layer = tf.keras.layers.Dense(1, dtype='float32')
 
 # Build our model based off EfficientNet
-inputs = tf.keras.Input(shape=(256, 256, 3))
-x = base_model(inputs, training=False)
+inputs = tf.keras.Input(shape=(256, 256, 1))
+x = layers.Rescaling(1./255)(inputs)
+x = gray2rgb(x)
+x = base_model(x, training=False)
 x = global_average_layer(x)
+feature_extractor = tf.keras.Model(inputs, x)
 # x = tf.keras.layers.Dropout(0.3)(x)
 outputs = prediction_layer(x)
 model_pretrained = tf.keras.Model(inputs, outputs)
 
-model_pretrained.compile(tf.keras.optimizers.Adam(learning_rate=0.0005),
-              loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
-              metrics=['accuracy'])
-
 model_pretrained.summary()
 
-history = model_pretrained.fit(train_X_RGB, train_y, epochs=20, shuffle=True, validation_data=(val_X_RGB, val_y))
+"""Since everything but the classification layer is frozen, the features EfficientNet produces for a subscene never change from one epoch to the next. Rather than running every subscene through EfficientNet on every epoch, I run it once, save the features, and train only the classification layer on them. To keep the benefit of data augmentation, the training features come from the original subscenes plus one augmented copy of each."""
+
+# Put training data into model to get features
+train_features = np.concatenate((feature_extractor.predict(train_eval_ds),
+                                 feature_extractor.predict(make_dataset(train_X, train_y, augment=True))))
+train_features_y = np.concatenate((train_y, train_y))
+val_features = feature_extractor.predict(val_ds)
+print(train_features.shape)
+
+np.save('train_features.npy', train_features)
+np.save('val_features.npy', val_features)
 
-train_loss, train_acc = model_pretrained.evaluate(train_X_RGB, train_y, verbose=2)
+# The classification layer on its own, trained on the saved features
+head = Sequential([prediction_layer])
+
+head.compile(tf.keras.optimizers.Adam(learning_rate=0.0005),
+              loss=tf.keras.losses.BinaryCrossentropy(from_logits=True),
+              metrics=[tf.keras.metrics.BinaryAccuracy(name='accuracy', threshold=0.0)])
+
+# Helper function for feeding the saved features to Keras, preparing the next batch while the current one trains
+def make_features_dataset(features, y, shuffle=False, batch_size=32):
+    ds = tf.data.Dataset.from_tensor_slices((features, y))
+    # The features are small enough to shuffle all of them every epoch
+    if shuffle:
+        ds = ds.shuffle(len(y))
+    return ds.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+train_features_ds = make_features_dataset(train_features, train_features_y, shuffle=True)
+val_features_ds = make_features_dataset(val_features, val_y)
+
+history = head.fit(train_features_ds, epochs=20, validation_data=val_features_ds)
+
+train_loss, train_acc = head.evaluate(make_features_dataset(train_features[:len(train_y)], train_y), verbose=2)
 print(f'Train accuracy: {100*train_acc:.2f}%')
 
 # Evaluate the model on the test data
-test_loss, test_acc = model_pretrained.evaluate(val_X_RGB,  val_y, verbose=2)
+test_loss, test_acc = head.evaluate(val_features_ds, verbose=2)
 print(f'Test accuracy: {100*test_acc:.2f}%')
 
-predictions = model_pretrained.predict(val_X_RGB)
+predictions = head.predict(val_features_ds)
 
-# Convert predictions to probabilities using softmax
-# https://en.wikipedia.org/wiki/Softmax_function
-predictions = tf.nn.softmax(predictions).numpy()
+# Convert predictions to probabilities using sigmoid
+# https://en.wikipedia.org/wiki/Sigmoid_function
+predictions = tf.sigmoid(predictions).numpy()[:, 0]
+predicted_labels = (predictions > 0.5).astype(int)
 
 """While my transfer learning model outperforms my custom model, it continues to be worse than a coin toss. Even with dropout layers, overfitting rears its head again as my model's training loss decreases but it's validation loss skyrockets."""
 
@@ -386,16 +521,8 @@ plt.show()
 """I again wanted to visualize my model's predictions. It is interesting to view what is predicted correctly and incorrectly. From visualization it seems that my model works well on larger ships but when the ships occupy only a few pixels it has trouble distinguishing them from the pixels of the ocean. Another interesting observation is that my model does well in distinguishing small islands from vessels, something I would not have thought it could do with its low accuracy."""
 
 # Visualize some predictions
-plt.figure(figsize=(20,20))
-for i in range(25):
-    index = np.random.randint(0, len(val_X))
-    plt.subplot(5,5,i+1)
-    plt.imshow(val_X[index], cmap='gray', vmin=np.nanmin(val_X[index]), vmax=np.nanmax(val_X[index]))
-    plt.xticks([])
-    plt.yticks([])
-    plt.title(f'Correct={val_y[index]}, Predicted={np.argmax(predictions[index])}')
-    plt.grid(False)
-plt.show()
+index = np.random.randint(0, len(val_X), size=25)
+show_grid(val_X[index], [f'Correct={val_y[i]}, Predicted={predicted_labels[i]}' for i in index], figsize=(20,20))
 
 """<hr class="solid">
 